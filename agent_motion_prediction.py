@@ -3,14 +3,14 @@
 
 # 测试git
 
-from typing import Dict
+from typing import Dict, Optional
 
 from tempfile import gettempdir
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 from torch import nn, optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset, Sampler
 from torchvision.models.resnet import resnet50
 from tqdm import tqdm
 
@@ -26,7 +26,11 @@ from l5kit.visualization import PREDICTED_POINTS_COLOR, TARGET_POINTS_COLOR, dra
 from prettytable import PrettyTable
 from pathlib import Path
 
+import hashlib
+import json
 import os
+import sys
+import zarr
 
 print("成功打开")
 # ## Prepare Data path and load cfg
@@ -79,19 +83,187 @@ def build_model(cfg: Dict) -> torch.nn.Module:
 # In[4]:
 
 
-def forward(data, model, device, criterion):
-    inputs = data["image"].to(device)
-    target_availabilities = data["target_availabilities"].unsqueeze(-1).to(device)
-    targets = data["target_positions"].to(device)
-    # Forward pass
-    outputs = model(inputs).reshape(targets.shape)
-    loss = criterion(outputs, targets)
+@torch.jit.script
+def masked_mse(outputs: torch.Tensor, targets: torch.Tensor, availabilities: torch.Tensor) -> torch.Tensor:
+    # on CUDA the TorchScript fuser merges subtract, square and mask into one elementwise kernel (after its
+    # profiling runs), so no separate per-element loss is materialised; the mean stays a separate reduction
+    diff = outputs - targets
+    return (diff * diff * availabilities).mean()
+
+
+def forward(data, model, device):
+    # batches come from pinned memory, so the copies can run asynchronously
+    inputs = data["image"].to(device, non_blocking=True)
+    # NHWC matches the layout of the model weights and of cuDNN's fastest fp16 kernels
+    if inputs.dtype == torch.uint8:
+        # cached rasters are quantized, scale them back to [0, 1] on the device
+        dtype = torch.float16 if device.type == "cuda" else torch.float32
+        inputs = inputs.to(dtype, memory_format=torch.channels_last).mul_(1 / 255)
+    else:
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
+    target_availabilities = data["target_availabilities"].unsqueeze(-1).to(device, non_blocking=True)
+    targets = data["target_positions"].to(device, non_blocking=True)
+    # Forward pass, in mixed precision on the GPU
+    with torch.autocast(device.type, dtype=torch.float16, enabled=device.type == "cuda"):
+        outputs = model(inputs).reshape(targets.shape)
+    # the loss and the predicted offsets are kept in full precision
+    outputs = outputs.float()
     # not all the output steps are valid, but we can filter them out from the loss using availabilities
-    loss = loss * target_availabilities
-    loss = loss.mean()
+    loss = masked_mse(outputs, targets, target_availabilities)
     return loss, outputs
 
 
+class CUDAPrefetcher:
+    """Iterate over a DataLoader while copying the next batch to the device on a side stream.
+
+    The copy of batch i+1 overlaps with the forward/backward of batch i. On CPU it just wraps the loader.
+    """
+
+    def __init__(self, loader: DataLoader, device: torch.device):
+        self.loader_iter = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device) if device.type == "cuda" else None
+        self.next_data = None
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.next_data = None
+            return
+        if self.stream is None:
+            self.next_data = batch
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_data = {k: v.to(self.device, non_blocking=True) if torch.is_tensor(v) else v
+                              for k, v in batch.items()}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_data is None:
+            raise StopIteration
+        data = self.next_data
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # the tensors were allocated on the copy stream but are consumed on the current one
+            for v in data.values():
+                if torch.is_tensor(v):
+                    v.record_stream(current_stream)
+        self.preload()
+        return data
+
+
+class CachedAgentDataset(Dataset):
+    """Cache the rasterized training samples of an `AgentDataset` in a zarr group on disk.
+
+    The first access of an index rasterizes it and stores the result; later epochs read the pre-rendered arrays.
+    Only the keys used by `forward` are returned, with the raster image quantized to uint8.
+    The cache must be opened with `open` before use.
+    """
+
+    keys = ("image", "target_positions", "target_availabilities")
+    # the targets are a few hundred bytes per sample, so they share chunks instead of one file each
+    target_chunk_size = 1024
+
+    def __init__(self, cfg: Dict, zarr_key: str, dataset: AgentDataset, cache_path: str):
+        self.cfg = cfg
+        self.zarr_key = zarr_key
+        self.dataset = dataset
+        self.cache_path = cache_path
+        self.store = None
+        self.arrays = None
+        self.image_chunk_suffix = None
+
+    def open(self) -> "CachedAgentDataset":
+        """Open the cache, rebuilding it if it was written for another raster/model config or dataset."""
+        sample = self.quantize(self.dataset[0])
+        num_samples = len(self.dataset)
+        # only the settings that change the rasterized samples, so runtime flags don't invalidate the cache
+        model_params = self.cfg["model_params"]
+        fingerprint = hashlib.sha1(json.dumps({
+            "raster_params": self.cfg["raster_params"],
+            "history_num_frames": model_params["history_num_frames"],
+            "history_step_size": model_params["history_step_size"],
+            "future_num_frames": model_params["future_num_frames"],
+            "future_step_size": model_params["future_step_size"],
+            "zarr_key": self.zarr_key,
+            "num_samples": num_samples,
+            "layout": 2,
+        }, sort_keys=True).encode()).hexdigest()
+
+        # several DataLoader workers update the target chunks shared by different samples concurrently
+        self.store = zarr.DirectoryStore(self.cache_path)
+        synchronizer = zarr.ProcessSynchronizer(self.cache_path + ".sync")
+        root = zarr.open_group(self.store, mode="a", synchronizer=synchronizer)
+        if root.attrs.get("fingerprint") != fingerprint:
+            if len(root):
+                print(f"{self.cache_path} was built for another config or dataset, rebuilding it")
+            root = zarr.open_group(self.store, mode="w", synchronizer=synchronizer)
+            root.attrs["fingerprint"] = fingerprint
+
+        # one image chunk per sample: samples are visited in random order, so larger chunks would be
+        # decompressed (and rewritten) whole to read or store a single ~10 MB raster
+        self.arrays = {
+            key: root.require_dataset(key, shape=(num_samples,) + sample[key].shape,
+                                      chunks=(1 if key == "image" else self.target_chunk_size,) + sample[key].shape,
+                                      dtype=sample[key].dtype)
+            for key in self.keys
+        }
+        # chunk keys are "<index>.0.0.0" (zarr's default "." separator); an existing image chunk marks a cached sample
+        self.image_chunk_suffix = ".0" * (sample["image"].ndim)
+        return self
+
+    def is_cached(self, index: int) -> bool:
+        return f"image/{index}{self.image_chunk_suffix}" in self.store
+
+    @staticmethod
+    def quantize(sample: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        # the raster channels are multiples of 1/255, so uint8 stores them exactly
+        sample["image"] = np.round(sample["image"] * 255).astype(np.uint8)
+        return sample
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, index: int) -> Dict[str, np.ndarray]:
+        if self.is_cached(index):
+            return {key: self.arrays[key][index] for key in self.keys}
+        sample = self.quantize(self.dataset[index])
+        # the image is written last (the store writes each chunk atomically), so its chunk only
+        # exists once the targets of the sample are stored
+        for key in reversed(self.keys):
+            self.arrays[key][index] = sample[key]
+        return {key: sample[key] for key in self.keys}
+
+
+class EpochPermutationSampler(Sampler):
+    """Shuffle the dataset indices with a numpy permutation seeded by `seed + epoch`.
+
+    Unlike `RandomSampler` it avoids an int64 `torch.randperm` and a full Python list of indices every epoch.
+    Call `set_epoch` before each epoch to reshuffle. Without a seed every run draws a fresh one.
+    """
+
+    def __init__(self, data_source: Dataset, seed: Optional[int] = None):
+        self.num_samples = len(data_source)
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = np.arange(self.num_samples, dtype=np.int32)
+        np.random.default_rng(self.seed + self.epoch).shuffle(indices)
+        return (int(index) for index in indices)
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+
 # ## Load the Train Data
 # 
 # Our data pipeline map a raw `.zarr` folder into a multi-processing instance ready for training by:
@@ -106,11 +278,27 @@ def forward(data, model, device, criterion):
 train_cfg = cfg["train_data_loader"]
 rasterizer = build_rasterizer(cfg, dm)
 train_zarr = ChunkedDataset(dm.require(train_cfg["key"])).open()
-train_dataset = AgentDataset(cfg, train_zarr, rasterizer)
-train_dataloader = DataLoader(train_dataset, shuffle=train_cfg["shuffle"], batch_size=train_cfg["batch_size"], 
-                             num_workers=train_cfg["num_workers"])
+# the cache is only opened (and built) on the training path
+train_dataset = CachedAgentDataset(cfg, train_cfg["key"], AgentDataset(cfg, train_zarr, rasterizer),
+                                   str(Path(log_dir).parent / "raster_cache.zarr"))
+# forked workers share the rasterizer's semantic map and the opened zarr with this process copy-on-write,
+# instead of rebuilding them per worker (the default start method is not fork on every Python version).
+# Only on Linux: macOS offers fork too, but it is unsafe there with the system frameworks
+worker_mp_context = "fork" if sys.platform.startswith("linux") else None
+if worker_mp_context is None and max(train_cfg["num_workers"], cfg["val_data_loader"]["num_workers"]) > 0:
+    # spawned workers would re-import and re-run this whole module-level script
+    raise ValueError("num_workers > 0 is only supported on Linux (fork workers), set num_workers to 0")
+# keep the rasterizing workers alive across epochs, with a few batches queued per worker
+train_worker_kwargs = {"persistent_workers": True, "prefetch_factor": 4, "multiprocessing_context": worker_mp_context} \
+    if train_cfg["num_workers"] > 0 else {}
+train_sampler = EpochPermutationSampler(train_dataset, cfg["train_params"]["shuffle_seed"]) \
+    if train_cfg["shuffle"] else None
+# drop the trailing partial batch so every step sees the same input shape
+train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=train_cfg["batch_size"], 
+                             num_workers=train_cfg["num_workers"], pin_memory=True, drop_last=True,
+                             **train_worker_kwargs)
 # num_workers=train_cfg["num_workers"]
-print(train_dataset)
+print(train_dataset.dataset)
 print(type(train_dataloader))
 
 
@@ -119,9 +307,20 @@ print(type(train_dataloader))
 
 # ==== INIT MODEL
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-model = build_model(cfg).to(device)
-optimizer = optim.Adam(model.parameters(), lr=1e-3)
-criterion = nn.MSELoss(reduction="none")
+# batch and raster sizes are fixed, so let cuDNN autotune the conv algorithms once and allow TF32 math
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+model = build_model(cfg).to(device, memory_format=torch.channels_last)
+# the fused implementation updates all parameter tensors in a single multi-tensor kernel (CUDA only)
+optimizer = optim.Adam(model.parameters(), lr=1e-3, fused=device.type == "cuda")
+scaler = torch.amp.GradScaler(device.type, enabled=device.type == "cuda")
+# fused kernels + CUDA-graph replay of the train/eval passes, only with torch_compile: True (eager otherwise);
+# `model` itself is kept for checkpoints and plotting
+if cfg["train_params"]["torch_compile"]:
+    compiled_model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+else:
+    compiled_model = model
 
 
 # # Training
@@ -132,28 +331,49 @@ criterion = nn.MSELoss(reduction="none")
 # In[7]:
 if not cfg["train_params"]["load_the_state"]:
     # ==== TRAIN LOOP
-    tr_it = iter(train_dataloader)
-    progress_bar = tqdm(range(cfg["train_params"]["max_num_steps"]))
-    losses_train = []
-    for _ in progress_bar:
+    # opened before the first iteration, so the workers inherit the opened cache
+    train_dataset.open()
+    epoch = 0
+    tr_it = CUDAPrefetcher(train_dataloader, device)
+    max_num_steps = cfg["train_params"]["max_num_steps"]
+    checkpoint_every_n_steps = cfg["train_params"]["checkpoint_every_n_steps"]
+    grad_accum_steps = cfg["train_params"]["grad_accum_steps"]
+    if grad_accum_steps < 1:
+        raise ValueError(f"grad_accum_steps must be >= 1, got {grad_accum_steps}")
+    if max_num_steps % grad_accum_steps != 0:
+        # the gradients of a trailing partial group would never be applied or checkpointed
+        raise ValueError(f"max_num_steps ({max_num_steps}) must be a multiple of grad_accum_steps ({grad_accum_steps})")
+    progress_bar = tqdm(range(max_num_steps))
+    # running loss kept on the device, only read back (which syncs) when the progress bar is refreshed
+    loss_sum = torch.zeros((), device=device)
+    num_losses = 0
+    model.train()
+    torch.set_grad_enabled(True)
+    for index in progress_bar:
         try:
             data = next(tr_it)
         except StopIteration:
-            tr_it = iter(train_dataloader)
+            epoch += 1
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
+            tr_it = CUDAPrefetcher(train_dataloader, device)
             data = next(tr_it)
-        model.train()
-        torch.set_grad_enabled(True)
-        loss, _ = forward(data, model, device, criterion)
-
-        # Backward pass
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        losses_train.append(loss.item())
-        progress_bar.set_description(f"loss: {loss.item()} loss(avg): {np.mean(losses_train)}")
-        state = {'model':model.state_dict(), 'optimizer':optimizer.state_dict()}
-        torch.save(state, log_dir)
+        loss, _ = forward(data, compiled_model, device)
+
+        # Backward pass, the optimizer steps once every grad_accum_steps batches
+        scaler.scale(loss / grad_accum_steps).backward()
+        if (index + 1) % grad_accum_steps == 0:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+
+        loss_sum += loss.detach()
+        num_losses += 1
+        if index % 50 == 0:
+            progress_bar.set_description(f"loss: {loss.item()} loss(avg): {(loss_sum / num_losses).item()}")
+        if (index + 1) % checkpoint_every_n_steps == 0 or index + 1 == max_num_steps:
+            state = {'model':model.state_dict(), 'optimizer':optimizer.state_dict(), 'scaler':scaler.state_dict()}
+            torch.save(state, log_dir)
     print("训练完成")
 
 else:
@@ -201,8 +421,9 @@ eval_zarr = ChunkedDataset(eval_zarr_path).open()
 eval_mask = np.load(eval_mask_path)["arr_0"]
 # ===== INIT DATASET AND LOAD MASK
 eval_dataset = AgentDataset(cfg, eval_zarr, rasterizer, agents_mask=eval_mask)
+eval_worker_kwargs = {"multiprocessing_context": worker_mp_context} if eval_cfg["num_workers"] > 0 else {}
 eval_dataloader = DataLoader(eval_dataset, shuffle=eval_cfg["shuffle"], batch_size=eval_cfg["batch_size"], 
-                             num_workers=eval_cfg["num_workers"])
+                             num_workers=eval_cfg["num_workers"], pin_memory=True, **eval_worker_kwargs)
 #num_workers=eval_cfg["num_workers"]
 print(eval_dataset)
 
@@ -216,19 +437,35 @@ print(eval_dataset)
 
 # ==== EVAL LOOP
 model.eval()
-torch.set_grad_enabled(False)
-
-# store information for evaluation
-future_coords_offsets_pd = []
-timestamps = []
 
-agent_ids = []
+# store information for evaluation, preallocated for the whole dataset and filled batch by batch
+num_agents = len(eval_dataset)
+# predictions are copied back into a pinned host buffer on a side stream, overlapping with the next batch
+d2h_stream = torch.cuda.Stream(device=device) if device.type == "cuda" else None
+future_coords_offsets_pd = torch.empty((num_agents, cfg["model_params"]["future_num_frames"], 2),
+                                       dtype=torch.float32, pin_memory=d2h_stream is not None)
+timestamps = np.empty(num_agents, dtype=np.int64)
+agent_ids = np.empty(num_agents, dtype=np.int64)
+offset = 0
 progress_bar = tqdm(eval_dataloader)
-for data in progress_bar:
-    _, ouputs = forward(data, model, device, criterion)
-    future_coords_offsets_pd.append(ouputs.cpu().numpy().copy())
-    timestamps.append(data["timestamp"].numpy().copy())
-    agent_ids.append(data["track_id"].numpy().copy())
+# inference mode also skips the autograd version counter and view tracking
+with torch.inference_mode():
+    for data in progress_bar:
+        _, ouputs = forward(data, compiled_model, device)
+        batch_size = ouputs.shape[0]
+        host_ouputs = future_coords_offsets_pd[offset:offset + batch_size]
+        if d2h_stream is not None:
+            d2h_stream.wait_stream(torch.cuda.current_stream(device))
+            with torch.cuda.stream(d2h_stream):
+                host_ouputs.copy_(ouputs, non_blocking=True)
+            ouputs.record_stream(d2h_stream)
+        else:
+            host_ouputs.copy_(ouputs)
+        timestamps[offset:offset + batch_size] = data["timestamp"].numpy()
+        agent_ids[offset:offset + batch_size] = data["track_id"].numpy()
+        offset += batch_size
+if d2h_stream is not None:
+    d2h_stream.synchronize()
     
 
 
@@ -244,9 +481,9 @@ for data in progress_bar:
 pred_path = f"{gettempdir()}/pred.csv"
 
 write_pred_csv(pred_path,
-               timestamps=np.concatenate(timestamps),
-               track_ids=np.concatenate(agent_ids),
-               coords=np.concatenate(future_coords_offsets_pd),
+               timestamps=timestamps[:offset],
+               track_ids=agent_ids[:offset],
+               coords=future_coords_offsets_pd[:offset].numpy(),
               )
 
 